@@ -1,20 +1,31 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, status
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import re
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr, validator
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, field_validator
+from typing import Awaitable, List, Literal, NoReturn, Optional, Union, get_args
 import uuid
+import hashlib
+import functools
 from datetime import datetime, timezone, timedelta
 import bcrypt
-from jose import JWTError, jwt
+import orjson
+import jwt
+from jwt import InvalidTokenError
 import cloudinary
 import cloudinary.utils
 import time
+from cachetools import TTLCache
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
 ROOT_DIR = Path(__file__).parent
@@ -22,27 +33,67 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+mongo_options = {
+    "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+    # Pool sizes are per worker process, so keep the idle floor small
+    "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', 1)),
+    "serverSelectionTimeoutMS": 5000,
+    "retryWrites": True
+}
+# Wire compression only pays off when MongoDB is on another host, so it is opt-in (e.g. "zlib" or "zstd,zlib")
+MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS', '')
+if MONGO_COMPRESSORS:
+    mongo_options["compressors"] = MONGO_COMPRESSORS
+    mongo_options["zlibCompressionLevel"] = 3
+client = AsyncIOMotorClient(mongo_url, **mongo_options)
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default_secret_change_in_production')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 JWT_EXPIRATION_HOURS = int(os.environ.get('JWT_EXPIRATION_HOURS', 24))
+JWT_ALGORITHMS = [JWT_ALGORITHM]
+JWT_EXPIRATION = timedelta(hours=JWT_EXPIRATION_HOURS)
+
+# Verified token cache Configuration
+TOKEN_CACHE_TTL_SECONDS = int(os.environ.get('TOKEN_CACHE_TTL_SECONDS', 300))
+TOKEN_CACHE_MAX_SIZE = 10_000
+
+# Product listing cache Configuration
+# Invalidation is per process, so it defaults on only for one worker. WEB_CONCURRENCY is the worker count
+# for both the entrypoint below and the uvicorn CLI; set the TTL to 0 when passing --workers explicitly.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+PRODUCT_LIST_CACHE_TTL_SECONDS = int(os.environ.get('PRODUCT_LIST_CACHE_TTL_SECONDS', 60 if WEB_CONCURRENCY == 1 else 0))
+PRODUCT_LIST_CACHE_MAX_SIZE = 1024
+
+# Password hashing Configuration
+# Cost 10 keeps a hash well under ~250 ms on a single core while remaining brute-force resistant
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 10))
+BCRYPT_MAX_WORKERS = int(os.environ.get('BCRYPT_MAX_WORKERS', 4))
 
 # LLM Configuration
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
+CHAT_SESSION_TTL_SECONDS = int(os.environ.get('CHAT_SESSION_TTL_SECONDS', 600))
+CHAT_SESSION_MAX_SIZE = 1000
 
 # Cloudinary Configuration
+CLOUDINARY_CLOUD_NAME = os.environ.get("CLOUDINARY_CLOUD_NAME")
+CLOUDINARY_API_KEY = os.environ.get("CLOUDINARY_API_KEY")
+CLOUDINARY_API_SECRET = os.environ.get("CLOUDINARY_API_SECRET")
+CLOUDINARY_SIGNATURE_BUCKET_SECONDS = 5
+
 cloudinary.config(
-    cloud_name=os.environ.get("CLOUDINARY_CLOUD_NAME"),
-    api_key=os.environ.get("CLOUDINARY_API_KEY"),
-    api_secret=os.environ.get("CLOUDINARY_API_SECRET"),
+    cloud_name=CLOUDINARY_CLOUD_NAME,
+    api_key=CLOUDINARY_API_KEY,
+    api_secret=CLOUDINARY_API_SECRET,
     secure=True
 )
 
+# CORS Configuration
+CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*').split(',')
+
 # Create the main app
-app = FastAPI(title="MUJ Campus Marketplace API")
+app = FastAPI(title="MUJ Campus Marketplace API", default_response_class=ORJSONResponse)
 
 # Create routers
 api_router = APIRouter(prefix="/api")
@@ -65,41 +116,82 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ==================== CONSTANTS ====================
-ALLOWED_CATEGORIES = [
+# Literal types are validated inside pydantic-core, no Python validator callback needed
+Category = Literal[
     "Room Essentials",
     "Books & Study Material",
     "Electronics",
     "Other Useful Stuff"
 ]
 
-ALLOWED_CONDITIONS = ["New", "Like New", "Used"]
+Condition = Literal["New", "Like New", "Used"]
+
+ALLOWED_CATEGORIES = list(get_args(Category))
+
+ALLOWED_CONDITIONS = list(get_args(Condition))
 
 MUJ_EMAIL_DOMAIN = "@muj.manipal.edu"
+MUJ_EMAIL_RE = re.compile(rf"[A-Za-z0-9._%+-]+{re.escape(MUJ_EMAIL_DOMAIN)}", re.IGNORECASE)
+
+# Cache-Control for responses that only change on deploy
+STATIC_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+# Seller-independent part of the AI chat system prompt
+CHAT_STATIC_CONTEXT = """MARKETPLACE CATEGORIES:
+- Room Essentials (Mattress, Table, Chair, Lamp, Fan, Mirror, Curtains)
+- Books & Study Material (Engineering books, notes, calculators)
+- Electronics (Laptop, Monitor, Keyboard, Mouse, Earphones, Phone)
+- Other Useful Stuff (Cycles, Bags, Water Bottles, Extension Boards)
+
+PRICING GUIDELINES (based on condition):
+- New: 70-90% of original price
+- Like New: 50-70% of original price
+- Used: 30-50% of original price
+
+Help the user with:
+1. Listing suggestions and pricing
+2. Understanding their sales performance
+3. Tips to sell items faster
+4. Answering marketplace queries
+
+Be helpful, friendly, and specific. Use the seller's actual data when answering questions."""
 
 # ==================== MODELS ====================
 
+# Same normalization EmailStr applied: surrounding whitespace removed and the domain lower-cased
+def normalize_email(v):
+    if not isinstance(v, str):
+        return v
+    local, at, domain = v.strip().rpartition("@")
+    return f"{local}@{domain.lower()}" if at else v.strip()
+
 class UserBase(BaseModel):
-    email: EmailStr
+    email: str
     name: str
 
 class UserCreate(UserBase):
-    password: str
+    password: str = Field(min_length=6)
     
-    @validator('email')
+    @field_validator('email', mode='before')
+    @classmethod
+    def normalize_email_input(cls, v):
+        return normalize_email(v)
+    
+    @field_validator('email')
+    @classmethod
     def validate_muj_email(cls, v):
-        if not v.endswith(MUJ_EMAIL_DOMAIN):
+        if not MUJ_EMAIL_RE.fullmatch(v):
             raise ValueError(f'Email must be a valid MUJ email ending with {MUJ_EMAIL_DOMAIN}')
         return v
-    
-    @validator('password')
-    def validate_password(cls, v):
-        if len(v) < 6:
-            raise ValueError('Password must be at least 6 characters')
-        return v
 
 class UserLogin(BaseModel):
-    email: EmailStr
+    email: str
     password: str
+    
+    @field_validator('email', mode='before')
+    @classmethod
+    def normalize_email_input(cls, v):
+        return normalize_email(v)
 
 class UserResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -115,59 +207,23 @@ class TokenResponse(BaseModel):
 
 class ProductBase(BaseModel):
     name: str
-    category: str
-    price: float
-    condition: str
+    category: Category
+    price: float = Field(gt=0)
+    condition: Condition
     description: str
-    images: List[str] = []
-    
-    @validator('category')
-    def validate_category(cls, v):
-        if v not in ALLOWED_CATEGORIES:
-            raise ValueError(f'Category must be one of: {", ".join(ALLOWED_CATEGORIES)}')
-        return v
-    
-    @validator('condition')
-    def validate_condition(cls, v):
-        if v not in ALLOWED_CONDITIONS:
-            raise ValueError(f'Condition must be one of: {", ".join(ALLOWED_CONDITIONS)}')
-        return v
-    
-    @validator('price')
-    def validate_price(cls, v):
-        if v <= 0:
-            raise ValueError('Price must be greater than 0')
-        return v
-    
-    @validator('images')
-    def validate_images(cls, v):
-        if len(v) == 0:
-            raise ValueError('At least one image is required')
-        return v
+    images: List[str] = Field(min_length=1)
 
 class ProductCreate(ProductBase):
     pass
 
 class ProductUpdate(BaseModel):
     name: Optional[str] = None
-    category: Optional[str] = None
+    category: Optional[Category] = None
     price: Optional[float] = None
-    condition: Optional[str] = None
+    condition: Optional[Condition] = None
     description: Optional[str] = None
     images: Optional[List[str]] = None
     is_sold: Optional[bool] = None
-    
-    @validator('category')
-    def validate_category(cls, v):
-        if v is not None and v not in ALLOWED_CATEGORIES:
-            raise ValueError(f'Category must be one of: {", ".join(ALLOWED_CATEGORIES)}')
-        return v
-    
-    @validator('condition')
-    def validate_condition(cls, v):
-        if v is not None and v not in ALLOWED_CONDITIONS:
-            raise ValueError(f'Condition must be one of: {", ".join(ALLOWED_CONDITIONS)}')
-        return v
 
 class ProductResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -185,6 +241,29 @@ class ProductResponse(BaseModel):
     created_at: str
     updated_at: str
 
+# Mongo projection returning exactly the ProductResponse fields, with the is_sold default for older products
+PRODUCT_PROJECTION = {
+    "_id": 0,
+    **{field: 1 for field in ProductResponse.model_fields},
+    "is_sold": {"$ifNull": ["$is_sold", False]}
+}
+
+# Search runs on lower-cased word tokens of name and description, stored as an indexed array so a
+# case-sensitive anchored prefix per typed word gets tight index bounds (no $text, which cannot sit in $or)
+SEARCH_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def search_terms(*texts: str) -> List[str]:
+    return sorted(set(SEARCH_TOKEN_RE.findall(" ".join(texts).lower())))
+
+# Server-side equivalent of search_terms(name, description) for pipeline updates and backfills
+SEARCH_TERMS_EXPR = {"$setUnion": [{"$map": {
+    "input": {"$regexFindAll": {
+        "input": {"$toLower": {"$concat": ["$name", " ", "$description"]}},
+        "regex": SEARCH_TOKEN_RE.pattern
+    }},
+    "in": "$$this.match"
+}}]}
+
 class WishlistItem(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -230,34 +309,95 @@ class MonthlySales(BaseModel):
     sold: int
     revenue: float
 
+# ==================== BACKGROUND TASKS ====================
+
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+_background_tasks = set()
+
+def _log_background_failure(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()!r}")
+
+async def _await_in_task(aw: Awaitable):
+    return await aw
+
+# Accepts any awaitable: Motor's write methods return executor Futures, which create_task rejects
+def run_in_background(aw: Awaitable) -> asyncio.Task:
+    task = asyncio.create_task(_await_in_task(aw))
+    _background_tasks.add(task)
+    task.add_done_callback(_log_background_failure)
+    return task
+
 # ==================== AUTH HELPERS ====================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# bcrypt is CPU-bound, so it runs in its own bounded pool to keep the event loop free
+_bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+
+# New hashes are stored as raw bytes (BSON binary) so logins skip re-encoding; older string hashes still verify
+def _hash_password_sync(password: str) -> bytes:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+def _verify_password_sync(password: str, hashed: Union[bytes, str]) -> bool:
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+
+async def hash_password(password: str) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(_bcrypt_pool, _hash_password_sync, password)
+
+async def verify_password(password: str, hashed: Union[bytes, str]) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_bcrypt_pool, _verify_password_sync, password, hashed)
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
+    expire = datetime.now(timezone.utc) + JWT_EXPIRATION
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+# Verified token -> (user_id, expires_at) cache, keyed by a digest of the token so raw tokens are never stored.
+# Only the id is cached: it never changes for a token, so the cache stays correct across workers,
+# while profile fields are always read from the users collection.
+_token_cache = TTLCache(maxsize=TOKEN_CACHE_MAX_SIZE, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+def _token_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+def _decode_token(token: str) -> tuple:
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
-    except JWTError:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=JWT_ALGORITHMS)
+    except InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user_id = payload.get("sub")
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user_id, payload.get("exp", 0)
+
+def _verify_token(token: str) -> str:
+    cache_key = _token_cache_key(token)
+    cached = _token_cache.get(cache_key)
+    if cached is not None:
+        user_id, expires_at = cached
+        if expires_at > time.time():
+            return user_id
+        _token_cache.pop(cache_key, None)
+    
+    user_id, exp = _decode_token(token)
+    # Never serve an entry past the token's own expiry
+    _token_cache[cache_key] = (user_id, min(exp, time.time() + TOKEN_CACHE_TTL_SECONDS))
+    return user_id
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    user_id = _verify_token(credentials.credentials)
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+# For endpoints that only need the caller's id: verifies the token without loading the user document
+async def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+    return _verify_token(credentials.credentials)
 
 # ==================== AUTH ROUTES ====================
 
@@ -274,11 +414,15 @@ async def register(user: UserCreate):
         "id": user_id,
         "email": user.email,
         "name": user.name,
-        "password": hash_password(user.password),
+        "password": await hash_password(user.password),
         "created_at": now
     }
     
-    await db.users.insert_one(user_doc)
+    # The unique email index catches concurrent sign-ups that both passed the check above
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     access_token = create_access_token({"sub": user_id})
     
     return TokenResponse(
@@ -289,7 +433,7 @@ async def register(user: UserCreate):
 @auth_router.post("/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await verify_password(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     access_token = create_access_token({"sub": user["id"]})
@@ -301,7 +445,7 @@ async def login(credentials: UserLogin):
 
 @auth_router.get("/me", response_model=UserResponse)
 async def get_me(current_user: dict = Depends(get_current_user)):
-    return UserResponse(
+    return UserResponse.model_construct(
         id=current_user["id"],
         email=current_user["email"],
         name=current_user["name"],
@@ -310,6 +454,16 @@ async def get_me(current_user: dict = Depends(get_current_user)):
 
 # ==================== PRODUCT ROUTES ====================
 
+# Encoded listing pages keyed by their query parameters; cleared on every product write.
+# The generation is bumped on each write so a query that started before the write never stores its stale page.
+_product_list_cache = TTLCache(maxsize=PRODUCT_LIST_CACHE_MAX_SIZE, ttl=max(PRODUCT_LIST_CACHE_TTL_SECONDS, 1))
+_product_list_generation = 0
+
+def invalidate_product_listings() -> None:
+    global _product_list_generation
+    _product_list_generation += 1
+    _product_list_cache.clear()
+
 @products_router.post("", response_model=ProductResponse)
 async def create_product(product: ProductCreate, current_user: dict = Depends(get_current_user)):
     product_id = str(uuid.uuid4())
@@ -323,6 +477,7 @@ async def create_product(product: ProductCreate, current_user: dict = Depends(ge
         "condition": product.condition,
         "description": product.description,
         "images": product.images,
+        "search_terms": search_terms(product.name, product.description),
         "seller_id": current_user["id"],
         "seller_name": current_user["name"],
         "seller_email": current_user["email"],
@@ -332,7 +487,9 @@ async def create_product(product: ProductCreate, current_user: dict = Depends(ge
     }
     
     await db.products.insert_one(product_doc)
-    return ProductResponse(**product_doc)
+    invalidate_product_listings()
+    product_doc.pop("search_terms")
+    return ProductResponse.model_construct(**product_doc)
 
 @products_router.get("", response_model=PaginatedProducts)
 async def get_products(
@@ -345,6 +502,13 @@ async def get_products(
     max_price: Optional[float] = None,
     exclude_sold: bool = False
 ):
+    cache_key = (page, limit, category, search, condition, min_price, max_price, exclude_sold)
+    if PRODUCT_LIST_CACHE_TTL_SECONDS > 0:
+        cached = _product_list_cache.get(cache_key)
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+    generation = _product_list_generation
+    
     query = {}
     
     if category:
@@ -354,10 +518,9 @@ async def get_products(
         query["condition"] = condition
     
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}}
-        ]
+        # Every typed word, including a partially typed last one, must prefix some stored term.
+        # Tokens are alphanumeric, so they need no escaping; a search with none matches nothing.
+        query["search_terms"] = {"$all": [re.compile(f"^{term}") for term in search_terms(search)]}
     
     if min_price is not None or max_price is not None:
         query["price"] = {}
@@ -371,144 +534,186 @@ async def get_products(
     if exclude_sold:
         query["is_sold"] = False
     
-    total = await db.products.count_documents(query)
     skip = (page - 1) * limit
-    pages = (total + limit - 1) // limit if total > 0 else 1
-    
-    products = await db.products.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
     
-    # Add default is_sold field for older products
-    for p in products:
-        if "is_sold" not in p:
-            p["is_sold"] = False
+    if not query:
+        # Unfiltered listing: the collection count comes from metadata, so run it alongside the page fetch
+        total, products = await asyncio.gather(
+            db.products.estimated_document_count(),
+            db.products.find({}, PRODUCT_PROJECTION).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+        )
+    else:
+        # Fetch the page and the exact filtered count in a single round-trip
+        pipeline = [
+            {"$match": query},
+            {"$facet": {
+                "data": [
+                    {"$sort": {"created_at": -1}},
+                    {"$skip": skip},
+                    {"$limit": limit},
+                    {"$project": PRODUCT_PROJECTION}
+                ],
+                "total": [{"$count": "n"}]
+            }}
+        ]
+        result = (await db.products.aggregate(pipeline).to_list(1))[0]
+        products = result["data"]
+        total = result["total"][0]["n"] if result["total"] else 0
+    pages = (total + limit - 1) // limit if total > 0 else 1
     
-    return PaginatedProducts(
-        products=[ProductResponse(**p) for p in products],
-        total=total,
-        page=page,
-        pages=pages
-    )
+    # Documents are already projected to the response shape, so skip the model layer and cache the encoded body
+    body = orjson.dumps({"products": products, "total": total, "page": page, "pages": pages})
+    if PRODUCT_LIST_CACHE_TTL_SECONDS > 0 and generation == _product_list_generation:
+        _product_list_cache[cache_key] = body
+    return Response(content=body, media_type="application/json")
 
 @products_router.get("/categories")
-async def get_categories():
+async def get_categories(response: Response):
+    response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
     return {"categories": ALLOWED_CATEGORIES}
 
 @products_router.get("/conditions")
-async def get_conditions():
+async def get_conditions(response: Response):
+    response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
     return {"conditions": ALLOWED_CONDITIONS}
 
+def product_etag(product: dict) -> str:
+    digest = hashlib.blake2b(orjson.dumps(product, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
 @products_router.get("/{product_id}", response_model=ProductResponse)
-async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
+async def get_product(product_id: str, request: Request, response: Response):
+    product = await db.products.find_one({"id": product_id}, PRODUCT_PROJECTION)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    if "is_sold" not in product:
-        product["is_sold"] = False
-    return ProductResponse(**product)
+    
+    # Clients revalidate with If-None-Match and get an empty 304 when the product is unchanged
+    etag = product_etag(product)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return ProductResponse.model_construct(**product)
 
-@products_router.put("/{product_id}", response_model=ProductResponse)
-async def update_product(product_id: str, update: ProductUpdate, current_user: dict = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
+# Called when an owner-scoped write matched nothing: tell a missing product apart from someone else's
+async def raise_product_access_error(product_id: str, forbidden_detail: str) -> NoReturn:
+    product = await db.products.find_one({"id": product_id}, {"_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    
-    if product["seller_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="You can only edit your own products")
-    
+    raise HTTPException(status_code=403, detail=forbidden_detail)
+
+@products_router.put("/{product_id}", response_model=ProductResponse)
+async def update_product(product_id: str, update: ProductUpdate, user_id: str = Depends(get_current_user_id)):
+    owned = {"id": product_id, "seller_id": user_id}
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
     
+    # Ownership check, update and read-back in one round-trip
     if update_data:
         update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
-        await db.products.update_one({"id": product_id}, {"$set": update_data})
+        # Pipeline update so search_terms can be rebuilt from whichever of name/description is unchanged;
+        # $literal keeps user values such as "$5 lamp" from being read as field paths
+        pipeline = [{"$set": {k: {"$literal": v} for k, v in update_data.items()}}]
+        if "name" in update_data or "description" in update_data:
+            pipeline.append({"$set": {"search_terms": SEARCH_TERMS_EXPR}})
+        updated_product = await db.products.find_one_and_update(
+            owned,
+            pipeline,
+            projection=PRODUCT_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+    else:
+        updated_product = await db.products.find_one(owned, PRODUCT_PROJECTION)
     
-    updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if "is_sold" not in updated_product:
-        updated_product["is_sold"] = False
-    return ProductResponse(**updated_product)
+    if updated_product is None:
+        await raise_product_access_error(product_id, "You can only edit your own products")
+    invalidate_product_listings()
+    return ProductResponse.model_construct(**updated_product)
 
 @products_router.post("/{product_id}/mark-sold")
-async def mark_product_sold(product_id: str, current_user: dict = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if product["seller_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="You can only mark your own products as sold")
-    
-    await db.products.update_one(
-        {"id": product_id}, 
+async def mark_product_sold(product_id: str, user_id: str = Depends(get_current_user_id)):
+    result = await db.products.update_one(
+        {"id": product_id, "seller_id": user_id},
         {"$set": {"is_sold": True, "sold_at": datetime.now(timezone.utc).isoformat()}}
     )
+    if result.matched_count == 0:
+        await raise_product_access_error(product_id, "You can only mark your own products as sold")
+    invalidate_product_listings()
     return {"message": "Product marked as sold"}
 
 @products_router.delete("/{product_id}")
-async def delete_product(product_id: str, current_user: dict = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if product["seller_id"] != current_user["id"]:
-        raise HTTPException(status_code=403, detail="You can only delete your own products")
+async def delete_product(product_id: str, user_id: str = Depends(get_current_user_id)):
+    deleted = await db.products.find_one_and_delete(
+        {"id": product_id, "seller_id": user_id},
+        projection={"_id": 1}
+    )
+    if deleted is None:
+        await raise_product_access_error(product_id, "You can only delete your own products")
+    invalidate_product_listings()
     
-    await db.products.delete_one({"id": product_id})
-    await db.wishlist.delete_many({"product_id": product_id})
+    # Orphaned wishlist rows are already skipped by the wishlist $lookup, so cleanup need not block the response
+    run_in_background(db.wishlist.delete_many({"product_id": product_id}))
     
     return {"message": "Product deleted successfully"}
 
 @products_router.get("/user/{user_id}", response_model=List[ProductResponse])
 async def get_user_products(user_id: str):
-    products = await db.products.find({"seller_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for p in products:
-        if "is_sold" not in p:
-            p["is_sold"] = False
-    return [ProductResponse(**p) for p in products]
+    # Collect documents while motor fetches the next batch; they are already in response shape
+    cursor = db.products.find({"seller_id": user_id}, PRODUCT_PROJECTION).sort("created_at", -1).limit(100).batch_size(50)
+    return ORJSONResponse([p async for p in cursor])
 
 # ==================== WISHLIST ROUTES ====================
 
 @wishlist_router.get("", response_model=List[ProductResponse])
-async def get_wishlist(current_user: dict = Depends(get_current_user)):
-    wishlist_items = await db.wishlist.find({"user_id": current_user["id"]}, {"_id": 0}).to_list(100)
-    product_ids = [item["product_id"] for item in wishlist_items]
-    
-    if not product_ids:
-        return []
-    
-    products = await db.products.find({"id": {"$in": product_ids}}, {"_id": 0}).to_list(100)
-    for p in products:
-        if "is_sold" not in p:
-            p["is_sold"] = False
-    return [ProductResponse(**p) for p in products]
+async def get_wishlist(user_id: str = Depends(get_current_user_id)):
+    # Join wishlist rows to their products server-side in one round-trip
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$limit": 100},
+        {"$lookup": {
+            "from": "products",
+            "localField": "product_id",
+            "foreignField": "id",
+            "as": "product"
+        }},
+        {"$unwind": "$product"},
+        {"$replaceRoot": {"newRoot": "$product"}},
+        {"$project": PRODUCT_PROJECTION}
+    ]
+    products = await db.wishlist.aggregate(pipeline).to_list(100)
+    return ORJSONResponse(products)
 
 @wishlist_router.post("/{product_id}")
-async def add_to_wishlist(product_id: str, current_user: dict = Depends(get_current_user)):
-    product = await db.products.find_one({"id": product_id})
+async def add_to_wishlist(product_id: str, user_id: str = Depends(get_current_user_id)):
+    product = await db.products.find_one({"id": product_id}, {"_id": 1})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    existing = await db.wishlist.find_one({"user_id": current_user["id"], "product_id": product_id})
-    if existing:
-        raise HTTPException(status_code=400, detail="Product already in wishlist")
-    
     wishlist_item = {
         "id": str(uuid.uuid4()),
-        "user_id": current_user["id"],
+        "user_id": user_id,
         "product_id": product_id,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.wishlist.insert_one(wishlist_item)
+    # The unique (user_id, product_id) index rejects duplicates atomically
+    try:
+        await db.wishlist.insert_one(wishlist_item)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Product already in wishlist")
     return {"message": "Added to wishlist"}
 
 @wishlist_router.delete("/{product_id}")
-async def remove_from_wishlist(product_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.wishlist.delete_one({"user_id": current_user["id"], "product_id": product_id})
+async def remove_from_wishlist(product_id: str, user_id: str = Depends(get_current_user_id)):
+    result = await db.wishlist.delete_one({"user_id": user_id, "product_id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not in wishlist")
     return {"message": "Removed from wishlist"}
 
 @wishlist_router.get("/check/{product_id}")
-async def check_wishlist(product_id: str, current_user: dict = Depends(get_current_user)):
-    existing = await db.wishlist.find_one({"user_id": current_user["id"], "product_id": product_id})
+async def check_wishlist(product_id: str, user_id: str = Depends(get_current_user_id)):
+    existing = await db.wishlist.find_one({"user_id": user_id, "product_id": product_id})
     return {"in_wishlist": existing is not None}
 
 # ==================== USER ROUTES ====================
@@ -516,28 +721,54 @@ async def check_wishlist(product_id: str, current_user: dict = Depends(get_curre
 @users_router.put("/profile", response_model=UserResponse)
 async def update_profile(name: str = Query(..., min_length=1), current_user: dict = Depends(get_current_user)):
     await db.users.update_one({"id": current_user["id"]}, {"$set": {"name": name}})
-    await db.products.update_many({"seller_id": current_user["id"]}, {"$set": {"seller_name": name}})
     
-    updated_user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0, "password": 0})
-    return UserResponse(**updated_user)
+    # Propagating the denormalized seller_name can touch every listing, so it does not hold up the response
+    propagation = run_in_background(db.products.update_many({"seller_id": current_user["id"]}, {"$set": {"seller_name": name}}))
+    propagation.add_done_callback(lambda _: invalidate_product_listings())
+    
+    return UserResponse.model_construct(
+        id=current_user["id"],
+        email=current_user["email"],
+        name=name,
+        created_at=current_user["created_at"]
+    )
 
 # ==================== ANALYTICS ROUTES ====================
 
 @analytics_router.get("/overview", response_model=AnalyticsOverview)
-async def get_analytics_overview(current_user: dict = Depends(get_current_user)):
-    user_id = current_user["id"]
+async def get_analytics_overview(user_id: str = Depends(get_current_user_id)):
+    # Product stats and wishlist count for the user's products in a single round-trip
+    pipeline = [
+        {"$match": {"seller_id": user_id}},
+        {"$facet": {
+            "stats": [
+                {"$group": {
+                    "_id": None,
+                    "total": {"$sum": 1},
+                    "sold": {"$sum": {"$cond": [{"$eq": ["$is_sold", True]}, 1, 0]}},
+                    "revenue": {"$sum": {"$cond": [{"$eq": ["$is_sold", True]}, "$price", 0]}}
+                }}
+            ],
+            "wishlist": [
+                {"$lookup": {
+                    "from": "wishlist",
+                    "localField": "id",
+                    "foreignField": "product_id",
+                    "as": "wishlist"
+                }},
+                {"$group": {"_id": None, "count": {"$sum": {"$size": "$wishlist"}}}}
+            ]
+        }}
+    ]
     
-    # Get all user's products
-    all_products = await db.products.find({"seller_id": user_id}, {"_id": 0}).to_list(1000)
+    result = (await db.products.aggregate(pipeline).to_list(1))[0]
+    stats = result["stats"][0] if result["stats"] else {"total": 0, "sold": 0, "revenue": 0}
     
-    total_listings = len(all_products)
-    sold_items = sum(1 for p in all_products if p.get("is_sold", False))
+    total_listings = stats["total"]
+    sold_items = stats["sold"]
     active_listings = total_listings - sold_items
-    total_revenue = sum(p["price"] for p in all_products if p.get("is_sold", False))
-    
-    # Count wishlist items for user's products
-    product_ids = [p["id"] for p in all_products]
-    wishlist_count = await db.wishlist.count_documents({"product_id": {"$in": product_ids}}) if product_ids else 0
+    total_revenue = stats["revenue"]
+    wishlist_count = result["wishlist"][0]["count"] if result["wishlist"] else 0
     
     return AnalyticsOverview(
         total_listings=total_listings,
@@ -548,9 +779,7 @@ async def get_analytics_overview(current_user: dict = Depends(get_current_user))
     )
 
 @analytics_router.get("/category-distribution", response_model=List[CategoryDistribution])
-async def get_category_distribution(current_user: dict = Depends(get_current_user)):
-    user_id = current_user["id"]
-    
+async def get_category_distribution(user_id: str = Depends(get_current_user_id)):
     pipeline = [
         {"$match": {"seller_id": user_id}},
         {"$group": {
@@ -569,12 +798,10 @@ async def get_category_distribution(current_user: dict = Depends(get_current_use
     ]
 
 @analytics_router.get("/monthly-sales", response_model=List[MonthlySales])
-async def get_monthly_sales(current_user: dict = Depends(get_current_user)):
-    user_id = current_user["id"]
-    
+async def get_monthly_sales(user_id: str = Depends(get_current_user_id)):
     # Get last 6 months of data
     now = datetime.now(timezone.utc)
-    months_data = []
+    months = []
     
     for i in range(5, -1, -1):
         month_start = (now.replace(day=1) - timedelta(days=i*30)).replace(day=1)
@@ -582,131 +809,166 @@ async def get_monthly_sales(current_user: dict = Depends(get_current_user)):
             month_end = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
         else:
             month_end = now
-        
-        month_name = month_start.strftime("%b %Y")
-        
-        # Count listings created in this month
-        listings = await db.products.count_documents({
-            "seller_id": user_id,
-            "created_at": {
-                "$gte": month_start.isoformat(),
-                "$lt": month_end.isoformat()
-            }
-        })
-        
-        # Count sold items and revenue
-        sold_products = await db.products.find({
-            "seller_id": user_id,
-            "is_sold": True,
-            "sold_at": {
-                "$gte": month_start.isoformat(),
-                "$lt": month_end.isoformat()
-            }
-        }, {"_id": 0, "price": 1}).to_list(1000)
-        
-        sold = len(sold_products)
-        revenue = sum(p["price"] for p in sold_products)
-        
-        months_data.append(MonthlySales(
-            month=month_name,
-            listings=listings,
-            sold=sold,
-            revenue=revenue
-        ))
+        months.append((month_start.strftime("%b %Y"), month_start.isoformat(), month_end.isoformat()))
     
-    return months_data
-
-@analytics_router.get("/top-products")
-async def get_top_products(current_user: dict = Depends(get_current_user)):
-    user_id = current_user["id"]
+    # Each month is bucketed by its start; any gap between months lands in its own unused bucket
+    boundaries = sorted({start for _, start, _ in months} | {end for _, _, end in months})
     
-    # Get products with most wishlist counts
-    products = await db.products.find({"seller_id": user_id}, {"_id": 0}).to_list(100)
+    pipeline = [
+        {"$match": {"seller_id": user_id}},
+        {"$facet": {
+            "listings": [
+                {"$bucket": {
+                    "groupBy": "$created_at",
+                    "boundaries": boundaries,
+                    "default": "other",
+                    "output": {"n": {"$sum": 1}}
+                }}
+            ],
+            "sold": [
+                {"$match": {"is_sold": True}},
+                {"$bucket": {
+                    "groupBy": "$sold_at",
+                    "boundaries": boundaries,
+                    "default": "other",
+                    "output": {"n": {"$sum": 1}, "revenue": {"$sum": "$price"}}
+                }}
+            ]
+        }}
+    ]
     
-    product_stats = []
-    for p in products:
-        wishlist_count = await db.wishlist.count_documents({"product_id": p["id"]})
-        product_stats.append({
-            "id": p["id"],
-            "name": p["name"],
-            "price": p["price"],
-            "category": p["category"],
-            "wishlist_count": wishlist_count,
-            "is_sold": p.get("is_sold", False)
-        })
+    result = (await db.products.aggregate(pipeline).to_list(1))[0]
+    listings = {b["_id"]: b["n"] for b in result["listings"]}
+    sold = {b["_id"]: b for b in result["sold"]}
     
-    # Sort by wishlist count
-    product_stats.sort(key=lambda x: x["wishlist_count"], reverse=True)
+    return [
+        MonthlySales(
+            month=month_name,
+            listings=listings.get(start, 0),
+            sold=sold[start]["n"] if start in sold else 0,
+            revenue=sold[start]["revenue"] if start in sold else 0
+        )
+        for month_name, start, _ in months
+    ]
+
+@analytics_router.get("/top-products")
+async def get_top_products(user_id: str = Depends(get_current_user_id)):
+    # Get products with most wishlist counts
+    pipeline = [
+        {"$match": {"seller_id": user_id}},
+        {"$lookup": {
+            "from": "wishlist",
+            "localField": "id",
+            "foreignField": "product_id",
+            "as": "wishlist"
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "name": 1,
+            "price": 1,
+            "category": 1,
+            "wishlist_count": {"$size": "$wishlist"},
+            "is_sold": {"$ifNull": ["$is_sold", False]}
+        }},
+        {"$sort": {"wishlist_count": -1}},
+        {"$limit": 5}
+    ]
     
-    return product_stats[:5]
+    return await db.products.aggregate(pipeline).to_list(5)
 
 # ==================== AI CHAT ROUTES ====================
 
+# Live chat sessions keyed by session id: {"chat": LlmChat, "lock": asyncio.Lock, "stats_digest": bytes}.
+# Entries are re-set on every message so the TTL counts from the last turn, not the first.
+_chat_sessions = TTLCache(maxsize=CHAT_SESSION_MAX_SIZE, ttl=CHAT_SESSION_TTL_SECONDS)
+
 @chat_router.post("", response_model=ChatResponse)
 async def chat_with_ai(message: ChatMessage, current_user: dict = Depends(get_current_user)):
     user_id = current_user["id"]
     user_name = current_user["name"]
     
-    # Get user's analytics for context
-    all_products = await db.products.find({"seller_id": user_id}, {"_id": 0}).to_list(100)
-    total_listings = len(all_products)
-    sold_items = sum(1 for p in all_products if p.get("is_sold", False))
-    total_revenue = sum(p["price"] for p in all_products if p.get("is_sold", False))
+    # Get user's analytics for context, rolled up server-side
+    pipeline = [
+        {"$match": {"seller_id": user_id}},
+        {"$facet": {
+            "categories": [
+                {"$group": {
+                    "_id": "$category",
+                    "count": {"$sum": 1},
+                    "sold": {"$sum": {"$cond": [{"$eq": ["$is_sold", True]}, 1, 0]}},
+                    "revenue": {"$sum": {"$cond": [{"$eq": ["$is_sold", True]}, "$price", 0]}}
+                }},
+                {"$sort": {"count": -1}}
+            ],
+            "recent": [
+                {"$sort": {"created_at": -1}},
+                {"$limit": 5},
+                {"$project": {"_id": 0, "name": 1, "price": 1, "category": 1, "is_sold": 1}}
+            ]
+        }}
+    ]
+    result = (await db.products.aggregate(pipeline).to_list(1))[0]
+    recent_products = result["recent"]
     
     # Category breakdown
-    category_counts = {}
-    for p in all_products:
-        cat = p["category"]
-        if cat not in category_counts:
-            category_counts[cat] = {"count": 0, "sold": 0, "revenue": 0}
-        category_counts[cat]["count"] += 1
-        if p.get("is_sold", False):
-            category_counts[cat]["sold"] += 1
-            category_counts[cat]["revenue"] += p["price"]
-    
-    # Build context for AI
-    context = f"""You are an AI assistant for MUJ Campus Marketplace, helping seller {user_name}.
-
-SELLER'S CURRENT STATS:
+    category_counts = {
+        r["_id"]: {"count": r["count"], "sold": r["sold"], "revenue": r["revenue"]}
+        for r in result["categories"]
+    }
+    total_listings = sum(data["count"] for data in category_counts.values())
+    sold_items = sum(data["sold"] for data in category_counts.values())
+    total_revenue = sum(data["revenue"] for data in category_counts.values())
+    
+    # Build context for AI; only the seller-specific block is formatted per request
+    category_lines = "\n".join(
+        f"- {cat}: {data['count']} listed, {data['sold']} sold, ₹{data['revenue']:,.0f} revenue"
+        for cat, data in category_counts.items()
+    ) or "No listings yet"
+    recent_lines = "\n".join(
+        f"- {p['name']} (₹{p['price']:,.0f}, {p['category']}, {'SOLD' if p.get('is_sold') else 'Active'})"
+        for p in recent_products
+    ) or "No products listed yet"
+    
+    seller_stats = f"""SELLER'S CURRENT STATS:
 - Total Listings: {total_listings}
 - Items Sold: {sold_items}
 - Active Listings: {total_listings - sold_items}
 - Total Revenue: ₹{total_revenue:,.0f}
 
 CATEGORY BREAKDOWN:
-{chr(10).join([f"- {cat}: {data['count']} listed, {data['sold']} sold, ₹{data['revenue']:,.0f} revenue" for cat, data in category_counts.items()]) if category_counts else "No listings yet"}
+{category_lines}
 
 RECENT PRODUCTS:
-{chr(10).join([f"- {p['name']} (₹{p['price']:,.0f}, {p['category']}, {'SOLD' if p.get('is_sold') else 'Active'})" for p in all_products[:5]]) if all_products else "No products listed yet"}
-
-MARKETPLACE CATEGORIES:
-- Room Essentials (Mattress, Table, Chair, Lamp, Fan, Mirror, Curtains)
-- Books & Study Material (Engineering books, notes, calculators)
-- Electronics (Laptop, Monitor, Keyboard, Mouse, Earphones, Phone)
-- Other Useful Stuff (Cycles, Bags, Water Bottles, Extension Boards)
-
-PRICING GUIDELINES (based on condition):
-- New: 70-90% of original price
-- Like New: 50-70% of original price
-- Used: 30-50% of original price
-
-Help the user with:
-1. Listing suggestions and pricing
-2. Understanding their sales performance
-3. Tips to sell items faster
-4. Answering marketplace queries
-
-Be helpful, friendly, and specific. Use the seller's actual data when answering questions."""
+{recent_lines}"""
 
+    session_id = f"muj-marketplace-{user_id}"
+    stats_digest = hashlib.blake2b(seller_stats.encode('utf-8'), digest_size=16).digest()
+    session = None
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"muj-marketplace-{user_id}",
-            system_message=context
-        ).with_model("gemini", "gemini-3-flash-preview")
+        # The full system prompt is sent once per session; later turns only carry the stats when they changed
+        session = _chat_sessions.get(session_id)
+        if session is None:
+            context = f"You are an AI assistant for MUJ Campus Marketplace, helping seller {user_name}.\n\n{seller_stats}\n\n{CHAT_STATIC_CONTEXT}"
+            session = {
+                "chat": LlmChat(
+                    api_key=EMERGENT_LLM_KEY,
+                    session_id=session_id,
+                    system_message=context
+                ).with_model("gemini", "gemini-3-flash-preview"),
+                "lock": asyncio.Lock(),
+                "stats_digest": stats_digest
+            }
+        _chat_sessions[session_id] = session
         
-        user_message = UserMessage(text=message.message)
-        response = await chat.send_message(user_message)
+        # One turn at a time per session so concurrent requests do not interleave the history
+        async with session["lock"]:
+            if session["stats_digest"] != stats_digest:
+                session["stats_digest"] = stats_digest
+                user_message = UserMessage(text=f"[Updated seller data]\n{seller_stats}\n\n{message.message}")
+            else:
+                user_message = UserMessage(text=message.message)
+            response = await session["chat"].send_message(user_message)
         
         # Store chat message in database
         chat_doc = {
@@ -716,20 +978,22 @@ Be helpful, friendly, and specific. Use the seller's actual data when answering
             "ai_response": response,
             "created_at": datetime.now(timezone.utc).isoformat()
         }
-        await db.chat_history.insert_one(chat_doc)
+        run_in_background(db.chat_history.insert_one(chat_doc))
         
         return ChatResponse(
             response=response,
             timestamp=datetime.now(timezone.utc).isoformat()
         )
     except Exception as e:
+        if session is not None and _chat_sessions.get(session_id) is session:
+            _chat_sessions.pop(session_id, None)
         logger.error(f"AI Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
 
 @chat_router.get("/history")
-async def get_chat_history(limit: int = Query(20, ge=1, le=100), current_user: dict = Depends(get_current_user)):
+async def get_chat_history(limit: int = Query(20, ge=1, le=100), user_id: str = Depends(get_current_user_id)):
     history = await db.chat_history.find(
-        {"user_id": current_user["id"]}, 
+        {"user_id": user_id}, 
         {"_id": 0}
     ).sort("created_at", -1).limit(limit).to_list(limit)
     
@@ -737,24 +1001,26 @@ async def get_chat_history(limit: int = Query(20, ge=1, le=100), current_user: d
 
 # ==================== CLOUDINARY ROUTES ====================
 
-@cloudinary_router.get("/signature", response_model=CloudinarySignature)
-async def generate_signature(
-    folder: str = "muj_marketplace",
-    current_user: dict = Depends(get_current_user)
-):
-    timestamp = int(time.time())
+# Timestamps are bucketed so bursts of uploads reuse one signature; Cloudinary accepts timestamps up to an hour old
+@functools.lru_cache(maxsize=128)
+def _signature_for_bucket(bucket: int, folder: str) -> tuple:
+    timestamp = bucket * CLOUDINARY_SIGNATURE_BUCKET_SECONDS
     params = {"timestamp": timestamp, "folder": folder}
-    
-    signature = cloudinary.utils.api_sign_request(
-        params,
-        os.environ.get("CLOUDINARY_API_SECRET")
-    )
+    return cloudinary.utils.api_sign_request(params, CLOUDINARY_API_SECRET), timestamp
+
+@cloudinary_router.get(
+    "/signature",
+    response_model=CloudinarySignature,
+    dependencies=[Depends(get_current_user_id)]
+)
+async def generate_signature(folder: str = "muj_marketplace"):
+    signature, timestamp = _signature_for_bucket(int(time.time()) // CLOUDINARY_SIGNATURE_BUCKET_SECONDS, folder)
     
     return CloudinarySignature(
         signature=signature,
         timestamp=timestamp,
-        cloud_name=os.environ.get("CLOUDINARY_CLOUD_NAME"),
-        api_key=os.environ.get("CLOUDINARY_API_KEY"),
+        cloud_name=CLOUDINARY_CLOUD_NAME,
+        api_key=CLOUDINARY_API_KEY,
         folder=folder
     )
 
@@ -782,11 +1048,92 @@ app.include_router(api_router)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_origins=CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warm_up_db_client():
+    # Forces server selection and the first pooled connection before traffic arrives
+    await db.command("ping")
+
+# Rows left behind by the old check-then-insert race; only needed while the unique wishlist index is missing
+async def remove_duplicate_wishlist_items() -> int:
+    pipeline = [
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "product_id": "$product_id"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ]
+    removed = 0
+    async for group in db.wishlist.aggregate(pipeline, allowDiskUse=True):
+        result = await db.wishlist.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    return removed
+
+# A unique index that cannot be built over existing data is logged instead of aborting startup.
+# With a deduplicate callback, a duplicate-key failure (code 11000) removes the duplicates and retries once.
+async def create_unique_index(collection, keys: list, deduplicate=None):
+    try:
+        await collection.create_index(keys, unique=True)
+        return
+    except OperationFailure as e:
+        if deduplicate is None or e.code != 11000:
+            logger.error(f"Could not create unique index {keys} on {collection.name}: {e}")
+            return
+    
+    removed = await deduplicate()
+    logger.warning(f"Removed {removed} duplicate documents from {collection.name} to build unique index {keys}")
+    try:
+        await collection.create_index(keys, unique=True)
+    except OperationFailure as e:
+        logger.error(f"Could not create unique index {keys} on {collection.name}: {e}")
+
+@app.on_event("startup")
+async def create_indexes():
+    await create_unique_index(db.users, [("email", 1)])
+    await create_unique_index(db.users, [("id", 1)])
+    await create_unique_index(db.products, [("id", 1)])
+    await db.products.create_index([("created_at", -1)])
+    await db.products.create_index([("search_terms", 1)])
+    await db.products.create_index([("category", 1), ("created_at", -1)])
+    await db.products.create_index([("category", 1), ("condition", 1), ("created_at", -1)])
+    await db.products.create_index([("seller_id", 1), ("created_at", -1)])
+    await db.products.create_index([("is_sold", 1), ("sold_at", -1)])
+    await create_unique_index(
+        db.wishlist, [("user_id", 1), ("product_id", 1)], deduplicate=remove_duplicate_wishlist_items
+    )
+    await db.wishlist.create_index([("product_id", 1)])
+
+@app.on_event("startup")
+async def backfill_search_terms():
+    # Products created before search_terms existed; a no-op once every product has them
+    result = await db.products.update_many({"search_terms": {"$exists": False}}, [{"$set": {"search_terms": SEARCH_TERMS_EXPR}}])
+    if result.modified_count:
+        logger.info(f"Backfilled search terms for {result.modified_count} products")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+# Production entrypoint: `python backend/server.py` (from any directory) runs uvicorn on uvloop/httptools.
+# One worker by default: chat sessions live in process memory, so WEB_CONCURRENCY > 1 needs sticky routing
+# by user (the listing cache switches itself off in that case).
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "server:app",
+        app_dir=str(ROOT_DIR),
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=int(os.environ.get('PORT', 8001)),
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=1024,
+        access_log=False
+    )